@@ -1,72 +1,238 @@
 import asyncpg
+import logging
+from cachetools import TTLCache
 import os
-import json
+import orjson
 from datetime import datetime, date
 from typing import Optional, List, Any
 from decimal import Decimal
+import asyncio
+
+# Hot-path statements, kept as constants so they can be prepared when a pool connection opens
+GET_USER_SQL = """
+SELECT u.*, p.daily_token_limit, p.priority
+FROM users u JOIN plans p ON u.plan_id = p.id
+WHERE u.platform = $1 AND u.platform_user_id = $2
+"""
+
+# Only for users not seen before: even a no-op DO UPDATE writes a new row version and
+# the insert draws a users.id value before the conflict is detected
+UPSERT_USER_SQL = """
+WITH u AS (
+    INSERT INTO users (platform, platform_user_id, ip_address, plan_id)
+    VALUES ($1, $2, $3, 1)
+    ON CONFLICT (platform, platform_user_id) DO UPDATE
+        SET ip_address = COALESCE(EXCLUDED.ip_address, users.ip_address)
+    RETURNING *
+)
+SELECT u.*, p.daily_token_limit, p.priority FROM u JOIN plans p ON u.plan_id = p.id
+"""
+
+# Taken in its own statement before INSERT_JOB_SQL so that statement's snapshot sees any job
+# a concurrent submission for the same user committed while we waited for the lock
+LOCK_USER_SQL = "SELECT 1 FROM users WHERE id = $1 FOR NO KEY UPDATE"
+
+# Inserts only if today's usage, plus jobs still queued or running, plus this job's cost fits the
+# user's plan limit; no row means over quota
+INSERT_JOB_SQL = """
+WITH used AS (
+    SELECT
+        COALESCE((SELECT tokens_used FROM usage_daily WHERE user_id = $1 AND date = $10), 0)
+        + COALESCE((SELECT SUM(cost_tokens) FROM jobs
+                    WHERE user_id = $1 AND status IN ('QUEUED', 'RUNNING')), 0) AS tokens
+), quota AS (
+    SELECT p.daily_token_limit FROM users u JOIN plans p ON u.plan_id = p.id WHERE u.id = $1
+), j AS (
+    INSERT INTO jobs (
+        user_id, frontend, bot_id, capability, status, priority,
+        params, cost_tokens, queued_at, metadata
+    )
+    SELECT $1::integer, $2::varchar, $3::varchar, $4::varchar, $5::varchar, $6::integer,
+        $7::jsonb, $8::numeric, NOW(), $9::jsonb
+    FROM used, quota
+    WHERE used.tokens + $8::numeric <= quota.daily_token_limit
+    RETURNING id, priority
+)
+SELECT j.id, pg_notify('jobs_queued', j.priority::text) FROM j
+"""
+
+MARK_COMPLETED_SQL = """
+UPDATE jobs SET status = 'COMPLETED', ended_at = NOW(),
+    execution_time_seconds = $2, metadata = COALESCE(metadata, '{}'::jsonb) || $3
+WHERE id = $1
+"""
+
+MARK_FAILED_SQL = "UPDATE jobs SET status = 'FAILED', ended_at = NOW(), error = $2 WHERE id = $1"
+
+CLAIM_NEXT_JOB_SQL = """
+UPDATE jobs SET status = 'RUNNING', worker_id = $2, started_at = NOW()
+WHERE id = (
+    SELECT id FROM jobs
+    WHERE status = 'QUEUED' AND capability = ANY($1::text[])
+    ORDER BY priority DESC, created_at ASC
+    FOR UPDATE SKIP LOCKED
+    LIMIT 1
+)
+RETURNING *
+"""
+
+UPDATE_USAGE_SQL = """
+INSERT INTO usage_daily (user_id, date, tokens_used, jobs_completed)
+VALUES ($1, $2, $3, $4)
+ON CONFLICT (user_id, date) DO UPDATE SET
+    tokens_used = usage_daily.tokens_used + $3,
+    jobs_completed = usage_daily.jobs_completed + $4
+"""
+
+HOT_STATEMENTS = (
+    GET_USER_SQL,
+    UPSERT_USER_SQL,
+    LOCK_USER_SQL,
+    INSERT_JOB_SQL,
+    MARK_COMPLETED_SQL,
+    MARK_FAILED_SQL,
+    CLAIM_NEXT_JOB_SQL,
+    UPDATE_USAGE_SQL,
+)
+
+# Binary jsonb wire format: a 1-byte version prefix followed by the JSON text
+JSONB_VERSION = b'\x01'
+
+# Pause between attempts to re-open a dropped LISTEN connection
+LISTEN_RECONNECT_SECONDS = 2
+
+def _encode_jsonb(value) -> bytes:
+    return JSONB_VERSION + orjson.dumps(value)
+
+def _decode_jsonb(data: bytes):
+    if data[:1] != JSONB_VERSION:
+        raise ValueError(f"Unsupported jsonb version: {data[:1]!r}")
+    return orjson.loads(data[1:])
 
 class AsyncDatabase:
     def __init__(self, database_url: str):
         self.database_url = database_url
         self.pool = None
+        self._listen_conn = None
+        self._listeners = [] # (channel, callback), re-subscribed after a reconnect
+        self._listen_reconnect: Optional[asyncio.Task] = None
+        self._closing = False
+        # Users and plans rarely change; (platform, platform_uid) -> user row joined with its plan
+        self._user_cache = TTLCache(maxsize=10_000, ttl=60)
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(self.database_url)
+        self.pool = await asyncpg.create_pool(
+            self.database_url,
+            min_size=4,
+            max_size=32,
+            max_inactive_connection_lifetime=300,
+            statement_cache_size=1024,
+            init=self._init_conn
+        )
+
+    async def _init_conn(self, conn):
+        await conn.set_type_codec(
+            'jsonb',
+            encoder=_encode_jsonb,
+            decoder=_decode_jsonb,
+            schema='pg_catalog',
+            format='binary'
+        )
+        await self._prepare_hot_stmts(conn)
+
+    async def _prepare_hot_stmts(self, conn):
+        # conn.prepare() bypasses the statement cache, so warm it the same way fetch()/execute() look it up.
+        # _get_statement is private asyncpg API; if it changes, skip warming instead of failing the pool.
+        get_statement = getattr(conn, '_get_statement', None)
+        if get_statement is None:
+            return
+        for query in HOT_STATEMENTS:
+            try:
+                await get_statement(query, None)
+            except TypeError:
+                logging.warning("asyncpg statement warm-up unavailable, skipping")
+                return
 
     async def disconnect(self):
+        self._closing = True
+        if self._listen_reconnect:
+            self._listen_reconnect.cancel()
+        if self._listen_conn:
+            await self._listen_conn.close()
         if self.pool:
             await self.pool.close()
 
+    async def add_listener(self, channel: str, callback):
+        # LISTEN needs a connection that stays open, so it does not come from the pool
+        self._listeners.append((channel, callback))
+        if self._listen_conn is None:
+            await self._open_listen_conn()
+        else:
+            await self._listen_conn.add_listener(channel, callback)
+
+    async def _open_listen_conn(self):
+        conn = await asyncpg.connect(self.database_url)
+        try:
+            for channel, callback in self._listeners:
+                await conn.add_listener(channel, callback)
+        except Exception:
+            await conn.close()
+            raise
+        conn.add_termination_listener(self._on_listen_conn_lost)
+        self._listen_conn = conn
+
+    def _on_listen_conn_lost(self, conn):
+        # Also called when disconnect() closes the connection on purpose
+        if self._closing or conn is not self._listen_conn:
+            return
+        logging.warning("LISTEN connection lost, reconnecting")
+        self._listen_conn = None
+        self._listen_reconnect = asyncio.create_task(self._reconnect_listener())
+
+    async def _reconnect_listener(self):
+        while not self._closing:
+            try:
+                await self._open_listen_conn()
+            except Exception as e:
+                logging.warning("LISTEN reconnect failed: %s", e)
+                await asyncio.sleep(LISTEN_RECONNECT_SECONDS)
+            else:
+                logging.info("LISTEN connection re-established")
+                return
+
     async def get_or_create_user(self, platform: str, platform_uid: str, ip_address: str = None):
-        async with self.pool.acquire() as conn:
-            # Try to get user
-            row = await conn.fetchrow(
-                "SELECT u.*, p.daily_token_limit, p.priority FROM users u JOIN plans p ON u.plan_id = p.id WHERE platform = $1 AND platform_user_id = $2",
-                platform, platform_uid
-            )
-            if row:
-                return row
-            
-            # Create if not exists (default plan_id=1 is Free)
-            user_id = await conn.fetchval(
-                "INSERT INTO users (platform, platform_user_id, ip_address, plan_id) VALUES ($1, $2, $3, 1) RETURNING id",
-                platform, platform_uid, ip_address
-            )
-            
-            # Fetch again to get plan details
-            return await conn.fetchrow(
-                "SELECT u.*, p.daily_token_limit, p.priority FROM users u JOIN plans p ON u.plan_id = p.id WHERE u.id = $1",
-                user_id
-            )
+        cached = self._user_cache.get((platform, platform_uid))
+        if cached is not None:
+            return cached
 
-    async def get_usage(self, user_id: int, date: date):
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT * FROM usage_daily WHERE user_id = $1 AND date = $2",
-                user_id, date
-            )
-            if not row:
-                # Return a dummy object or create a row. Let's return a simple object wrapper.
-                class Usage:
-                    tokens_used = 0
-                return Usage()
-            return row
-
-    async def create_job(self, job_data: dict):
+            # Existing users are a plain read; only new ones pay for the upsert
+            row = await conn.fetchrow(GET_USER_SQL, platform, platform_uid)
+            if row is None:
+                # Upsert and join plan details in one round-trip (default plan_id=1 is Free)
+                row = await conn.fetchrow(
+                    UPSERT_USER_SQL,
+                    platform, platform_uid, ip_address
+                )
+        self._user_cache[(platform, platform_uid)] = row
+        return row
+
+    async def create_job(self, job_data: dict, usage_date: date):
         async with self.pool.acquire() as conn:
-            job_id = await conn.fetchval(
-                """
-                INSERT INTO jobs (
-                    user_id, frontend, bot_id, capability, status, priority, 
-                    params, cost_tokens, created_at, metadata
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-                RETURNING id
-                """,
-                job_data["user_id"], job_data["frontend"], job_data["bot_id"],
-                job_data["capability"], job_data["status"], job_data["priority"],
-                json.dumps(job_data["params"]), job_data["cost_tokens"], 
-                job_data["created_at"], json.dumps(job_data.get("reply_context", {}))
-            )
+            # The user row lock serializes submissions per user, so two concurrent
+            # requests cannot both pass the quota check
+            async with conn.transaction():
+                await conn.execute(LOCK_USER_SQL, job_data["user_id"])
+                # Quota check, insert and NOTIFY to LISTENing schedulers in one statement
+                job_id = await conn.fetchval(
+                    INSERT_JOB_SQL,
+                    job_data["user_id"], job_data["frontend"], job_data["bot_id"],
+                    job_data["capability"], job_data["status"], job_data["priority"],
+                    job_data["params"], job_data["cost_tokens"],
+                    job_data.get("reply_context", {}), usage_date
+                )
+            if job_id is None:
+                return None
             
             # Return a simple object with id
             class Job:
@@ -74,11 +240,10 @@ class AsyncDatabase:
             return Job(job_id)
 
     async def update_job(self, job_id, **kwargs):
+        # Generic fallback for rare fields; the hot transitions use claim_next_job and the mark_* methods
         set_clauses = []
         values = []
         for i, (k, v) in enumerate(kwargs.items(), start=2):
-            if isinstance(v, (dict, list)):
-                v = json.dumps(v)
             set_clauses.append(f"{k} = ${i}")
             values.append(v)
         
@@ -87,65 +252,69 @@ class AsyncDatabase:
         async with self.pool.acquire() as conn:
             await conn.execute(query, job_id, *values)
 
-    async def count_queued_jobs_before(self, job_id, priority: int):
+    async def complete_job(self, job_id, execution_time_seconds, metadata: dict,
+                           user_id, usage_date: date, tokens_used_increment):
         async with self.pool.acquire() as conn:
-            # Count jobs with higher priority OR same priority but created earlier
-            # Note: This is a simplification.
-            return await conn.fetchval(
-                """
-                SELECT COUNT(*) FROM jobs 
-                WHERE status = 'QUEUED' 
-                AND (priority > $1 OR (priority = $1 AND created_at < (SELECT created_at FROM jobs WHERE id = $2)))
-                """,
-                priority, job_id
+            # One transaction, so the job's cost is always counted either as RUNNING (by the quota
+            # check) or in usage_daily, and completion is never recorded without the charge
+            async with conn.transaction():
+                # Merge into existing metadata so reply_context survives completion
+                await conn.execute(
+                    MARK_COMPLETED_SQL,
+                    job_id, execution_time_seconds, metadata
+                )
+                await conn.execute(
+                    UPDATE_USAGE_SQL,
+                    user_id, usage_date, tokens_used_increment, 1
+                )
+
+    async def mark_failed(self, job_id, error: dict):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                MARK_FAILED_SQL,
+                job_id, error
+            )
+
+    async def count_queued_jobs_by_priority(self) -> dict:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT priority, COUNT(*) AS n FROM jobs WHERE status = 'QUEUED' GROUP BY priority"
             )
+            return {row['priority']: row['n'] for row in rows}
 
-    async def get_next_queued_job(self, priority: int, capability: list):
+    async def claim_next_job(self, capabilities: list, worker_id: str):
         async with self.pool.acquire() as conn:
-            # Select oldest job with specific priority and capability
-            # Capabilities matching is simplified here.
+            # Pick the highest priority, oldest queued job and mark it running in one statement.
+            # SKIP LOCKED lets concurrent dispatchers claim different jobs without blocking.
             row = await conn.fetchrow(
-                """
-                SELECT * FROM jobs 
-                WHERE status = 'QUEUED' AND priority = $1 
-                ORDER BY created_at ASC 
-                LIMIT 1
-                """,
-                priority
+                CLAIM_NEXT_JOB_SQL,
+                capabilities, worker_id
             )
             if row:
-                # Parse params from JSON string
-                row = dict(row)
-                row['params'] = json.loads(row['params'])
-                return row
+                return dict(row)
             return None
 
-    async def create_artifact(self, artifact_data: dict):
+    async def create_artifacts_bulk(self, job_id, artifacts: List[dict]) -> List[str]:
+        if not artifacts:
+            return []
         async with self.pool.acquire() as conn:
-             id = await conn.fetchval(
+            # One INSERT ... SELECT over parallel arrays instead of a statement per artifact
+            rows = await conn.fetch(
                 """
                 INSERT INTO artifacts (job_id, type, local_path, public_url, metadata, format)
-                VALUES ($1, $2, $3, $4, $5, 'png') RETURNING id
-                """,
-                artifact_data["job_id"], artifact_data["type"], artifact_data["path"],
-                artifact_data["url"], json.dumps(artifact_data["metadata"])
-             )
-             class Artifact:
-                 def __init__(self, id): self.id = id
-             return Artifact(id)
-
-    async def update_usage(self, user_id, date, tokens_used_increment, jobs_completed_increment):
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO usage_daily (user_id, date, tokens_used, jobs_completed)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT (user_id, date) DO UPDATE SET
-                    tokens_used = usage_daily.tokens_used + $3,
-                    jobs_completed = usage_daily.jobs_completed + $4
+                SELECT $1, a.type, a.local_path, a.public_url, a.metadata, 'png'
+                FROM unnest($2::text[], $3::text[], $4::text[], $5::jsonb[])
+                    AS a(type, local_path, public_url, metadata)
+                RETURNING id
                 """,
-                user_id, date, tokens_used_increment, jobs_completed_increment
+                job_id,
+                [a["type"] for a in artifacts],
+                [a["path"] for a in artifacts],
+                [a["url"] for a in artifacts],
+                [a["metadata"] for a in artifacts]
             )
+            # asyncpg returns its own UUID subclass, which orjson refuses to serialize
+            return [str(row['id']) for row in rows]
 
     async def get_user(self, user_id):
         async with self.pool.acquire() as conn:
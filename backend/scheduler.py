@@ -1,162 +1,272 @@
 import asyncio
 import logging
 import httpx
-from datetime import datetime
+import orjson
+import time
+from datetime import datetime, date, timezone
 from backend.database import AsyncDatabase
 
+IDLE_RECHECK_SECONDS = 5
+QUEUE_RECONCILE_SECONDS = 60
+NOTIFY_TIMEOUT_SECONDS = 10
+INTERNAL_SECRET_HEADER = "X-Internal-Secret"
+
+# Current UTC date, refreshed once a minute instead of computing it per request
+_utc_today: date = datetime.now(timezone.utc).date()
+
+def utc_today() -> date:
+    return _utc_today
+
+async def refresh_utc_today():
+    global _utc_today
+    while True:
+        _utc_today = datetime.now(timezone.utc).date()
+        await asyncio.sleep(60)
+
 class WorkerProxy:
-    def __init__(self, worker_id, base_url, capabilities):
+    def __init__(self, worker_id, base_url, capabilities, client: httpx.AsyncClient):
         self.id = worker_id
         self.base_url = base_url
         self.capabilities = capabilities
         self.status = "idle"
         self.loaded_models = []
-        self.last_heartbeat = datetime.utcnow()
+        self.last_heartbeat = time.monotonic()
+        self._client = client
 
     def is_healthy(self):
         # Check if heartbeat is recent (e.g. < 1 min)
-        return (datetime.utcnow() - self.last_heartbeat).total_seconds() < 60
+        return time.monotonic() - self.last_heartbeat < 60
 
     async def run_job(self, payload: dict, timeout: int = 300):
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"{self.base_url}/worker/run_job",
-                json=payload,
-                timeout=timeout + 10
-            )
-            resp.raise_for_status()
-            return resp.json()
+        resp = await self._client.post(
+            f"{self.base_url}/worker/run_job",
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=timeout + 10
+        )
+        resp.raise_for_status()
+        return orjson.loads(resp.content)
 
 class WorkerManager:
     def __init__(self):
         self.workers = {} # id -> WorkerProxy
+        self.bot_callbacks = {} # bot_id -> notify URL
+        # Shared by all workers so connections are pooled and kept alive
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(320.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
 
     def register_worker(self, worker_id, url, capabilities):
-        self.workers[worker_id] = WorkerProxy(worker_id, url, capabilities)
+        worker = self.workers.get(worker_id)
+        if worker and worker.base_url == url:
+            # Refresh in place so a busy worker is not reset to idle by its heartbeat
+            worker.capabilities = capabilities
+            worker.last_heartbeat = time.monotonic()
+            return
+        self.workers[worker_id] = WorkerProxy(worker_id, url, capabilities, self.client)
+
+    def register_bot(self, bot_id, callback_url):
+        self.bot_callbacks[bot_id] = callback_url
+
+    async def close(self):
+        await self.client.aclose()
 
     def all(self):
         return self.workers.values()
 
 class Scheduler:
-    def __init__(self, db: AsyncDatabase, worker_manager: WorkerManager):
+    def __init__(self, db: AsyncDatabase, worker_manager: WorkerManager, internal_secret: str = None):
         self.db = db
         self.workers = worker_manager
+        # Sent with frontend callbacks so bots can reject results from anyone else
+        self.internal_secret = internal_secret
+        # Frontend notifications in flight; kept so they are not garbage collected and can be drained
+        self._notify_tasks: set[asyncio.Task] = set()
         self.dispatch_running = False
+        self._wakeup = asyncio.Event()
+        # Approximate queued job counts per priority, used for queue position estimates
+        self._queued_counts: dict[int, int] = {}
+
+    def wake(self):
+        """Wake the dispatch loop (new job queued or worker became available)."""
+        self._wakeup.set()
+
+    def record_enqueued(self, priority: int):
+        self._queued_counts[priority] = self._queued_counts.get(priority, 0) + 1
+
+    def record_dispatched(self, priority: int):
+        self._queued_counts[priority] = max(0, self._queued_counts.get(priority, 0) - 1)
+
+    def queue_position(self, priority: int) -> int:
+        """Estimated number of queued jobs ahead of a new job with this priority."""
+        return sum(n for p, n in self._queued_counts.items() if p >= priority)
+
+    async def reconcile_queue_counts(self):
+        """Periodically resync the in-memory counts with the database."""
+        while self.dispatch_running:
+            try:
+                self._queued_counts = await self.db.count_queued_jobs_by_priority()
+            except Exception as e:
+                logging.error("Queue count reconcile failed: %s", e)
+            await asyncio.sleep(QUEUE_RECONCILE_SECONDS)
+
+    def _on_job_queued(self, conn, pid, channel, payload):
+        self.wake()
+
+    async def _wait_for_wakeup(self):
+        # The timeout is only a safety net for missed notifications and expiring heartbeats
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=IDLE_RECHECK_SECONDS)
+        except asyncio.TimeoutError:
+            pass
 
     async def start_dispatch_loop(self):
         """Main loop that dispatches jobs to workers."""
         logging.info("Starting dispatch loop...")
         self.dispatch_running = True
+        await self.db.add_listener("jobs_queued", self._on_job_queued)
+        asyncio.create_task(self.reconcile_queue_counts())
         
-        while self.dispatch_running:
-            try:
-                # 1. Find idle worker
-                worker = await self.find_idle_worker()
-                if not worker:
-                    await asyncio.sleep(1)
-                    continue
-                
-                # 2. Select next job (priority + affinity)
-                job = await self.select_next_job(worker)
-                if not job:
-                    await asyncio.sleep(1)
-                    continue
-                
-                # 3. Dispatch
-                logging.info(f"Dispatching job {job['id']} to worker {worker.id}")
-                asyncio.create_task(self.dispatch_job(worker, job))
-                
-            except Exception as e:
-                logging.error(f"Dispatch error: {e}")
-                await asyncio.sleep(2)
+        # The TaskGroup keeps references to in-flight dispatches and awaits them on exit.
+        # In-flight work is already bounded by the worker count: a job is only claimed for an idle worker.
+        async with asyncio.TaskGroup() as tg:
+            while self.dispatch_running:
+                try:
+                    # Clear before looking, so a wake-up during the checks below is not lost
+                    self._wakeup.clear()
+
+                    # Try every idle worker: one whose capabilities match nothing queued
+                    # must not block the others
+                    dispatched = False
+                    for worker in self.find_idle_workers():
+                        # 1. Claim next job (priority + affinity)
+                        job = await self.select_next_job(worker)
+                        if not job:
+                            continue
+                        
+                        # 2. Dispatch
+                        logging.info("Dispatching job %s to worker %s", job['id'], worker.id)
+                        worker.status = "busy"
+                        self.record_dispatched(job['priority'])
+                        tg.create_task(self._dispatch_guarded(worker, job))
+                        dispatched = True
 
-    async def find_idle_worker(self) -> WorkerProxy | None:
-        """Find a healthy worker not currently executing."""
-        for worker in self.workers.all():
-            if worker.status == "idle" and worker.is_healthy():
-                return worker
-        return None
+                    if not dispatched:
+                        await self._wait_for_wakeup()
+                    
+                except Exception as e:
+                    logging.error("Dispatch error: %s", e)
+                    await asyncio.sleep(2)
+
+    async def _dispatch_guarded(self, worker: WorkerProxy, job: dict):
+        # Errors must not escape: one failing task would cancel the whole TaskGroup
+        try:
+            await self.dispatch_job(worker, job)
+        except Exception as e:
+            logging.error("Unhandled dispatch error for job %s: %s", job['id'], e)
+
+    def find_idle_workers(self) -> list[WorkerProxy]:
+        """Healthy workers not currently executing."""
+        return [w for w in self.workers.all() if w.status == "idle" and w.is_healthy()]
 
     async def select_next_job(self, worker: WorkerProxy) -> dict | None:
-        """Select highest priority job that this worker can handle."""
-        # Simplified: just check priority
-        for priority in [3, 2, 1, 0]:
-            job = await self.db.get_next_queued_job(priority=priority, capability=worker.capabilities)
-            if job:
-                return job
-        return None
+        """Claim highest priority job that this worker can handle."""
+        return await self.db.claim_next_job(worker.capabilities, worker.id)
 
     async def dispatch_job(self, worker: WorkerProxy, job: dict):
-        """Send job to worker for execution."""
+        """Send job to worker for execution. The job is already claimed as RUNNING."""
         
-        # 1. Update job status
-        worker.status = "busy"
-        await self.db.update_job(
-            job['id'],
-            status="RUNNING",
-            started_at=datetime.utcnow().isoformat(),
-            worker_id=worker.id
-        )
-        
-        # 2. Prepare payload
+        # 1. Prepare payload
         payload = {
             "job_id": str(job['id']),
             "params": job['params'],
             "timeout_seconds": 300
         }
         
-        # 3. Send to worker
+        # 2. Send to worker
         try:
             response = await worker.run_job(payload, timeout=310)
-            await self.handle_job_completion(job, response)
+            artifacts = await self.handle_job_completion(job, response)
             
         except Exception as e:
-            logging.error(f"Job dispatch failed: {e}")
+            logging.error("Job dispatch failed: %s", e)
             await self.handle_job_failure(job, "DISPATCH_ERROR", str(e))
+        else:
+            # 3. Push the result only once every write has committed, so the frontend never
+            # gets COMPLETED followed by FAILED (in the background, so the worker is freed right away)
+            self.notify_frontend_later(job, "COMPLETED", artifacts=artifacts)
         finally:
             worker.status = "idle"
+            self.wake()
 
-    async def handle_job_completion(self, job: dict, response: dict):
-        """Handle successful job completion."""
+    async def handle_job_completion(self, job: dict, response: dict) -> list:
+        """Record successful job completion and return the artifacts to push to the frontend."""
         artifacts_data = response.get("artifacts", [])
         execution_time = response.get("execution_time_seconds", 0)
         
-        # 1. Save artifacts
-        artifact_ids = []
-        for artifact in artifacts_data:
-            # Need to fix up artifact data to match DB expectation
-            art_record = await self.db.create_artifact({
-                "job_id": job['id'],
+        # 1. Save artifacts (single batched insert)
+        artifact_ids = await self.db.create_artifacts_bulk(job['id'], [
+            {
                 "type": artifact.get("type", "image"),
                 "path": artifact.get("path"),
                 "url": artifact.get("url"),
                 "metadata": artifact.get("metadata", {})
-            })
-            artifact_ids.append(art_record.id)
+            }
+            for artifact in artifacts_data
+        ])
         
-        # 2. Update job
-        await self.db.update_job(
+        # 2. Update job and deduct tokens together
+        await self.db.complete_job(
             job['id'],
-            status="COMPLETED",
-            ended_at=datetime.utcnow().isoformat(),
             execution_time_seconds=execution_time,
-            metadata={"artifact_ids": artifact_ids}
-        )
-        
-        # 3. Deduct tokens
-        user = await self.db.get_user(job['user_id'])
-        await self.db.update_usage(
-            user_id=user['id'],
-            date=datetime.utcnow().date(),
-            tokens_used_increment=job['cost_tokens'],
-            jobs_completed_increment=1
+            metadata={"artifact_ids": artifact_ids},
+            user_id=job['user_id'],
+            usage_date=utc_today(),
+            tokens_used_increment=job['cost_tokens']
         )
+        return artifacts_data
 
     async def handle_job_failure(self, job: dict, error_code: str, message: str):
         """Handle job failure."""
-        await self.db.update_job(
+        await self.db.mark_failed(
             job['id'],
-            status="FAILED",
-            ended_at=datetime.utcnow().isoformat(),
             error={"code": error_code, "message": message}
         )
+        self.notify_frontend_later(job, "FAILED", error={"code": error_code, "message": message})
+
+    def notify_frontend_later(self, job: dict, status: str, artifacts: list = None, error: dict = None):
+        task = asyncio.create_task(self.notify_frontend(job, status, artifacts=artifacts, error=error))
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+
+    async def wait_for_notifications(self, timeout: float = NOTIFY_TIMEOUT_SECONDS):
+        """Give pending frontend notifications a chance to finish (used on shutdown)."""
+        if self._notify_tasks:
+            await asyncio.wait(set(self._notify_tasks), timeout=timeout)
+
+    async def notify_frontend(self, job: dict, status: str, artifacts: list = None, error: dict = None):
+        """POST the job outcome to the bot that submitted it, if it registered a callback."""
+        callback_url = self.workers.bot_callbacks.get(job['bot_id'])
+        if not callback_url:
+            return
+        payload = {
+            "job_id": str(job['id']),
+            "status": status,
+            "reply_context": job.get('metadata') or {},
+            "artifacts": artifacts or [],
+            "error": error
+        }
+        headers = {"Content-Type": "application/json"}
+        if self.internal_secret:
+            headers[INTERNAL_SECRET_HEADER] = self.internal_secret
+        try:
+            resp = await self.workers.client.post(
+                callback_url,
+                content=orjson.dumps(payload),
+                headers=headers,
+                timeout=NOTIFY_TIMEOUT_SECONDS
+            )
+            resp.raise_for_status()
+        except Exception as e:
+            logging.error("Frontend notify failed for job %s: %s", job['id'], e)
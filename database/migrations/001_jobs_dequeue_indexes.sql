@@ -0,0 +1,15 @@
+-- Dequeue index for the jobs table.
+-- CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction block, so apply
+-- this file with autocommit (e.g. plain psql -f).
+
+-- Matches the dispatcher's ORDER BY priority DESC, created_at ASC.
+-- Only queued rows are indexed, which keeps the index small; status is fixed by the
+-- predicate, so it is not a key column.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS jobs_dequeue_idx
+  ON jobs (priority DESC, created_at ASC)
+  WHERE status = 'QUEUED';
+
+-- Superseded by jobs_dequeue_idx. Nothing orders or filters RUNNING jobs by priority,
+-- and each extra index is maintained on every insert and QUEUED -> RUNNING update.
+DROP INDEX CONCURRENTLY IF EXISTS idx_jobs_active;
+DROP INDEX CONCURRENTLY IF EXISTS idx_jobs_status_priority;
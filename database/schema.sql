@@ -76,12 +76,12 @@ CREATE TABLE jobs (
 CREATE INDEX idx_jobs_user_id ON jobs(user_id);
 CREATE INDEX idx_jobs_status ON jobs(status);
 CREATE INDEX idx_jobs_created_at ON jobs(created_at DESC);
-CREATE INDEX idx_jobs_status_priority ON jobs(status, priority DESC) WHERE status IN ('QUEUED', 'RUNNING');
 CREATE INDEX idx_jobs_worker_id ON jobs(worker_id) WHERE worker_id IS NOT NULL;
 CREATE INDEX idx_jobs_user_status ON jobs(user_id, status);
-CREATE INDEX idx_jobs_active ON jobs(status, priority DESC, created_at)
-WHERE status IN ('QUEUED', 'RUNNING');
 CREATE INDEX idx_jobs_params_model ON jobs USING GIN(params) WHERE capability = 'image';
+-- Serves the dispatcher's claim (ORDER BY priority DESC, created_at ASC) and the per-priority queue counts
+CREATE INDEX jobs_dequeue_idx ON jobs(priority DESC, created_at ASC)
+WHERE status = 'QUEUED';
 
 -- Artifacts Table
 CREATE TABLE artifacts (
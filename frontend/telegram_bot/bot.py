@@ -1,7 +1,9 @@
 import logging
 import os
+import hmac
 import asyncio
 import httpx
+from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
@@ -9,6 +11,13 @@ from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandl
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 SCHEDULER_URL = os.getenv("SCHEDULER_URL", "http://localhost:8000")
 BOT_ID = "tg-bot-1"
+# The scheduler POSTs job results here instead of the bot polling for them
+CALLBACK_HOST = os.getenv("BOT_CALLBACK_HOST", "127.0.0.1")
+CALLBACK_PORT = int(os.getenv("BOT_CALLBACK_PORT", "8081"))
+CALLBACK_URL = os.getenv("BOT_CALLBACK_URL", f"http://localhost:{CALLBACK_PORT}/frontend/notify")
+# Shared with the scheduler; sent on heartbeats and required on incoming callbacks
+INTERNAL_API_SECRET = os.getenv("INTERNAL_API_SECRET", "")
+INTERNAL_SECRET_HEADER = "X-Internal-Secret"
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -43,43 +52,110 @@ async def generate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(f"{SCHEDULER_URL}/api/v1/jobs", json=payload, timeout=10)
-            
-            if resp.status_code == 402:
-                await update.message.reply_text("Quota exceeded!")
-                return
-            
-            resp.raise_for_status()
-            data = resp.json()
-            
-            await update.message.reply_text(
-                f"Job Queued! ID: {data['job_id']}\nEst time: {data['estimated_time_seconds']}s"
-            )
-            
-            # Start polling in background
-            asyncio.create_task(poll_job(data['job_id'], update.effective_chat.id))
+        client: httpx.AsyncClient = context.application.bot_data['http']
+        resp = await client.post(f"{SCHEDULER_URL}/api/v1/jobs", json=payload, timeout=10)
+        
+        if resp.status_code == 402:
+            await update.message.reply_text("Quota exceeded!")
+            return
+        
+        resp.raise_for_status()
+        data = resp.json()
+        
+        await update.message.reply_text(
+            f"Job Queued! ID: {data['job_id']}\nEst time: {data['estimated_time_seconds']}s"
+        )
             
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.error("Error: %s", e)
         await update.message.reply_text("Failed to create job.")
 
-async def poll_job(job_id: str, chat_id: int):
-    # Simple polling logic
-    attempts = 0
-    # Create a new application instance or use global/context? 
-    # For simplicity in this script, we can't easily access the bot instance to send message back 
-    # without passing it. But we don't have it here easily.
-    # We will just print to log for now, as this is a scaffold.
-    # In production, this needs a proper notification system (webhook or persistent poller).
-    pass 
+async def heartbeat_loop(client: httpx.AsyncClient):
+    # Keeps the scheduler's callback registration fresh (e.g. after a scheduler restart)
+    while True:
+        try:
+            resp = await client.post(f"{SCHEDULER_URL}/api/internal/heartbeat", headers={
+                INTERNAL_SECRET_HEADER: INTERNAL_API_SECRET
+            }, json={
+                "bot_id": BOT_ID,
+                "callback_url": CALLBACK_URL
+            })
+            # A rejected heartbeat (e.g. wrong INTERNAL_API_SECRET) is logged below
+            resp.raise_for_status()
+        except Exception as e:
+            logging.error("Heartbeat failed: %s", e)
+        await asyncio.sleep(30)
+
+async def deliver_result(bot, data: dict):
+    reply_context = data.get("reply_context") or {}
+    chat_id = reply_context.get("chat_id")
+    if chat_id is None:
+        return
+    reply_to = reply_context.get("message_id")
+
+    try:
+        if data.get("status") != "COMPLETED":
+            await bot.send_message(chat_id, "Sorry, your job failed.", reply_to_message_id=reply_to)
+            return
+
+        for artifact in data.get("artifacts", []):
+            if artifact.get("type") == "image" and artifact.get("url"):
+                await bot.send_photo(chat_id, artifact["url"], reply_to_message_id=reply_to)
+            else:
+                metadata = artifact.get("metadata") or {}
+                text = metadata.get("content") or metadata.get("transcription")
+                if text:
+                    await bot.send_message(chat_id, text, reply_to_message_id=reply_to)
+    except Exception as e:
+        logging.error("Delivering job %s failed: %s", data.get("job_id"), e)
+
+def make_notify_handler(application: Application):
+    deliveries = set()
+
+    async def notify(request: web.Request):
+        secret = request.headers.get(INTERNAL_SECRET_HEADER, "")
+        if not (INTERNAL_API_SECRET and hmac.compare_digest(secret, INTERNAL_API_SECRET)):
+            return web.json_response({"status": "forbidden"}, status=403)
+        data = await request.json()
+
+        # Acknowledge right away; sending to Telegram happens after the response
+        task = asyncio.create_task(deliver_result(application.bot, data))
+        deliveries.add(task)
+        task.add_done_callback(deliveries.discard)
+        return web.json_response({"status": "accepted"}, status=202)
+    return notify
+
+async def post_init(application: Application):
+    if not INTERNAL_API_SECRET:
+        logging.warning("INTERNAL_API_SECRET is not set; heartbeats and job callbacks will be rejected")
+    # One shared client for all handlers so scheduler connections are reused
+    application.bot_data['http'] = httpx.AsyncClient()
+
+    notify_app = web.Application()
+    notify_app.router.add_post("/frontend/notify", make_notify_handler(application))
+    runner = web.AppRunner(notify_app)
+    await runner.setup()
+    await web.TCPSite(runner, CALLBACK_HOST, CALLBACK_PORT).start()
+    application.bot_data['notify_runner'] = runner
+    application.bot_data['heartbeat'] = asyncio.create_task(heartbeat_loop(application.bot_data['http']))
+
+async def post_shutdown(application: Application):
+    application.bot_data['heartbeat'].cancel()
+    await application.bot_data['notify_runner'].cleanup()
+    await application.bot_data['http'].aclose()
 
 def main():
     if not TOKEN:
         print("Error: TELEGRAM_BOT_TOKEN not set")
         return
 
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("generate", generate))
@@ -0,0 +1,287 @@
+import asyncio
+import contextlib
+import uuid
+import httpx
+import orjson
+
+import asyncpg
+from asyncpg.pgproto import pgproto
+
+from backend import database
+from backend.database import AsyncDatabase, MARK_COMPLETED_SQL, UPDATE_USAGE_SQL, _decode_jsonb, _encode_jsonb
+from backend.scheduler import Scheduler, WorkerManager
+
+
+class FakeDB:
+    """In-memory stand-in for AsyncDatabase covering what the dispatch loop calls."""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.claims = []
+        self.completed = {}
+        self.failed = {}
+
+    async def add_listener(self, channel, callback):
+        pass
+
+    async def count_queued_jobs_by_priority(self):
+        return {}
+
+    async def claim_next_job(self, capabilities, worker_id):
+        self.claims.append((tuple(capabilities), worker_id))
+        for job in self.jobs:
+            if job['status'] == 'QUEUED' and job['capability'] in capabilities:
+                job['status'] = 'RUNNING'
+                job['worker_id'] = worker_id
+                return dict(job)
+        return None
+
+    async def create_artifacts_bulk(self, job_id, artifacts):
+        return [f"artifact-{i}" for i, _ in enumerate(artifacts)]
+
+    async def complete_job(self, job_id, execution_time_seconds, metadata,
+                           user_id, usage_date, tokens_used_increment):
+        self.completed[job_id] = metadata
+
+    async def mark_failed(self, job_id, error):
+        self.failed[job_id] = error
+
+
+def make_job(job_id, capability):
+    return {
+        'id': job_id, 'status': 'QUEUED', 'capability': capability, 'priority': 0,
+        'params': {}, 'user_id': 1, 'bot_id': None, 'cost_tokens': 1, 'metadata': {}
+    }
+
+
+async def run_loop(scheduler, until, timeout=2.0):
+    loop_task = asyncio.create_task(scheduler.start_dispatch_loop())
+    try:
+        async with asyncio.timeout(timeout):
+            while not until():
+                await asyncio.sleep(0.01)
+    finally:
+        scheduler.dispatch_running = False
+        scheduler.wake()
+        await asyncio.wait_for(loop_task, 2)
+
+
+def test_job_goes_to_idle_worker_with_matching_capability():
+    async def main():
+        db = FakeDB([make_job('text-job', 'text')])
+        workers = WorkerManager()
+        # Registered first, so it is the first idle worker the loop sees
+        workers.register_worker('image-worker', 'http://image', ['image'])
+        workers.register_worker('text-worker', 'http://text', ['text'])
+        ran_on = []
+        for worker in workers.all():
+            async def run_job(payload, timeout=300, worker_id=worker.id):
+                ran_on.append(worker_id)
+                return {"artifacts": []}
+            worker.run_job = run_job
+
+        scheduler = Scheduler(db, workers)
+        await run_loop(scheduler, until=lambda: 'text-job' in db.completed)
+        await workers.close()
+        return ran_on
+
+    assert asyncio.run(main()) == ['text-worker']
+
+
+class FakeConnection:
+    """Answers AsyncDatabase's queries and applies the jsonb codec to jsonb parameters."""
+
+    def __init__(self):
+        self.completed_metadata = None
+        self.usage = []
+        self.in_transaction = False
+        # (query, ran inside a transaction) for every execute()
+        self.executed = []
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        self.in_transaction = True
+        try:
+            yield
+        finally:
+            self.in_transaction = False
+
+    async def fetch(self, query, *args):
+        # create_artifacts_bulk: asyncpg hands back its own UUID type for RETURNING id
+        return [{'id': pgproto.UUID(str(uuid.uuid4()))} for _ in args[1]]
+
+    async def execute(self, query, *args):
+        self.executed.append((query, self.in_transaction))
+        if query == MARK_COMPLETED_SQL:
+            self.completed_metadata = _decode_jsonb(_encode_jsonb(args[2]))
+        elif query == UPDATE_USAGE_SQL:
+            self.usage.append(args)
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self.conn
+
+
+def test_completion_records_artifacts_and_usage():
+    async def main():
+        conn = FakeConnection()
+        db = AsyncDatabase("postgresql://unused")
+        db.pool = FakePool(conn)
+        workers = WorkerManager()
+        scheduler = Scheduler(db, workers)
+
+        job = make_job(uuid.uuid4(), 'image')
+        await scheduler.handle_job_completion(job, {
+            "execution_time_seconds": 5.0,
+            "artifacts": [{"type": "image", "url": "https://example.com/a.png", "path": "/tmp/a.png"}]
+        })
+        await workers.close()
+        return conn
+
+    conn = asyncio.run(main())
+    assert len(conn.completed_metadata["artifact_ids"]) == 1
+    assert len(conn.usage) == 1
+    # Completion and its charge commit together
+    assert conn.executed == [(MARK_COMPLETED_SQL, True), (UPDATE_USAGE_SQL, True)]
+
+
+def test_stopping_the_loop_waits_for_in_flight_dispatches():
+    async def main():
+        db = FakeDB([make_job('slow-job', 'image')])
+        workers = WorkerManager()
+        workers.register_worker('image-worker', 'http://image', ['image'])
+        worker = next(iter(workers.all()))
+
+        async def run_job(payload, timeout=300):
+            await asyncio.sleep(0.2)
+            return {"artifacts": []}
+        worker.run_job = run_job
+
+        scheduler = Scheduler(db, workers)
+        await run_loop(scheduler, until=lambda: worker.status == "busy")
+        await workers.close()
+        return db
+
+    db = asyncio.run(main())
+    assert 'slow-job' in db.completed
+
+
+def test_worker_is_freed_before_the_frontend_is_notified():
+    async def main():
+        job = make_job('notify-job', 'image')
+        job['bot_id'] = 'bot'
+        db = FakeDB([job])
+        workers = WorkerManager()
+        workers.register_worker('image-worker', 'http://image', ['image'])
+        workers.register_bot('bot', 'http://bot/frontend/notify')
+        worker = next(iter(workers.all()))
+
+        async def run_job(payload, timeout=300):
+            return {"artifacts": []}
+        worker.run_job = run_job
+
+        notified = asyncio.Event()
+        release = asyncio.Event()
+        async def post(url, **kwargs):
+            notified.set()
+            await release.wait()
+            return httpx.Response(202, request=httpx.Request("POST", url))
+        workers.client.post = post
+
+        scheduler = Scheduler(db, workers, internal_secret='s3cret')
+        await run_loop(scheduler, until=lambda: notified.is_set())
+        # The callback is still hanging, yet the worker is already idle
+        freed = worker.status == "idle"
+        release.set()
+        await scheduler.wait_for_notifications()
+        await workers.close()
+        return freed
+
+    assert asyncio.run(main())
+
+
+def test_failed_completion_sends_only_the_failure():
+    async def main():
+        job = make_job('broken-job', 'image')
+        job['bot_id'] = 'bot'
+        db = FakeDB([job])
+
+        async def complete_job(*args, **kwargs):
+            raise RuntimeError("connection reset")
+        db.complete_job = complete_job
+
+        workers = WorkerManager()
+        workers.register_worker('image-worker', 'http://image', ['image'])
+        workers.register_bot('bot', 'http://bot/frontend/notify')
+        worker = next(iter(workers.all()))
+
+        async def run_job(payload, timeout=300):
+            return {"artifacts": [{"type": "image", "url": "https://example.com/a.png"}]}
+        worker.run_job = run_job
+
+        sent = []
+        async def post(url, content=None, **kwargs):
+            sent.append(orjson.loads(content)['status'])
+            return httpx.Response(202, request=httpx.Request("POST", url))
+        workers.client.post = post
+
+        scheduler = Scheduler(db, workers)
+        await run_loop(scheduler, until=lambda: 'broken-job' in db.failed)
+        await scheduler.wait_for_notifications()
+        await workers.close()
+        return sent
+
+    assert asyncio.run(main()) == ['FAILED']
+
+
+class FakeListenConnection:
+    def __init__(self):
+        self.channels = []
+        self.termination_listeners = []
+
+    async def add_listener(self, channel, callback):
+        self.channels.append(channel)
+
+    def add_termination_listener(self, callback):
+        self.termination_listeners.append(callback)
+
+    def drop(self):
+        for callback in self.termination_listeners:
+            callback(self)
+
+    async def close(self):
+        self.drop()
+
+
+def test_listen_connection_is_reopened_after_it_drops(monkeypatch):
+    async def main():
+        opened = []
+        attempts = []
+        async def connect(dsn):
+            attempts.append(dsn)
+            # The first reconnect attempt fails while Postgres is still restarting
+            if len(attempts) == 2:
+                raise OSError("connection refused")
+            conn = FakeListenConnection()
+            opened.append(conn)
+            return conn
+        monkeypatch.setattr(asyncpg, "connect", connect)
+        monkeypatch.setattr(database, "LISTEN_RECONNECT_SECONDS", 0)
+
+        db = AsyncDatabase("postgresql://unused")
+        await db.add_listener('jobs_queued', lambda *args: None)
+        opened[0].drop()
+        async with asyncio.timeout(1):
+            while db._listen_conn is None:
+                await asyncio.sleep(0)
+        await db.disconnect()
+        return opened
+
+    opened = asyncio.run(main())
+    assert len(opened) == 2
+    assert opened[1].channels == ['jobs_queued']
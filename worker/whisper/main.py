@@ -1,43 +1,82 @@
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Request
+from fastapi.responses import Response
+import msgspec
 import asyncio
 import os
 import httpx
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 app = FastAPI()
-logging.basicConfig(level=logging.INFO)
+# Log records are queued and written by a background thread so handlers never block the event loop
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(log_queue, log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
 
 SCHEDULER_URL = os.getenv("SCHEDULER_URL", "http://localhost:8000")
 WORKER_ID = os.getenv("WORKER_ID", "worker-gpu-2")
+INTERNAL_API_SECRET = os.getenv("INTERNAL_API_SECRET", "")
 MY_URL = os.getenv("WORKER_URL", "http://localhost:9002")
 
+# Shared client, created on startup so heartbeats reuse one connection pool
+http_client: httpx.AsyncClient = None
+
+class RunJobReq(msgspec.Struct):
+    job_id: str
+    params: dict
+    timeout_seconds: int = 300
+
+async def parse_run_job(request: Request) -> RunJobReq:
+    # Decode and validate in one pass with msgspec instead of going through pydantic
+    try:
+        return msgspec.json.decode(await request.body(), type=RunJobReq)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
 @app.on_event("startup")
 async def startup():
+    global http_client
+    log_listener.start()
+    # Eager tasks run synchronously until their first await (Python 3.12+)
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    http_client = httpx.AsyncClient()
     asyncio.create_task(heartbeat_loop())
 
+@app.on_event("shutdown")
+async def shutdown():
+    await http_client.aclose()
+    log_listener.stop()
+
 async def heartbeat_loop():
     while True:
         try:
-            async with httpx.AsyncClient() as client:
-                await client.post(f"{SCHEDULER_URL}/api/internal/heartbeat", json={
-                    "worker_id": WORKER_ID,
-                    "url": MY_URL,
-                    "capabilities": ["audio"]
-                })
+            resp = await http_client.post(f"{SCHEDULER_URL}/api/internal/heartbeat", headers={
+                "X-Internal-Secret": INTERNAL_API_SECRET
+            }, json={
+                "worker_id": WORKER_ID,
+                "url": MY_URL,
+                "capabilities": ["audio"]
+            })
+            # A rejected heartbeat (e.g. wrong INTERNAL_API_SECRET) is logged below
+            resp.raise_for_status()
         except Exception as e:
-            logging.error(f"Heartbeat failed: {e}")
+            logging.error("Heartbeat failed: %s", e)
         await asyncio.sleep(30)
 
 @app.post("/worker/run_job")
-async def run_job(request: dict, background_tasks: BackgroundTasks):
-    logging.info(f"Received audio job: {request['job_id']}")
+async def run_job(background_tasks: BackgroundTasks, request: RunJobReq = Depends(parse_run_job)):
+    logging.info("Received audio job: %s", request.job_id)
     
     # Simulate Whisper or TTS
     await asyncio.sleep(3)
     
-    return {
+    return Response(content=msgspec.json.encode({
         "status": "completed",
-        "job_id": request['job_id'],
+        "job_id": request.job_id,
         "execution_time_seconds": 3.0,
         "artifacts": [
             {
@@ -47,7 +86,7 @@ async def run_job(request: dict, background_tasks: BackgroundTasks):
                 "url": None
             }
         ]
-    }
+    }), media_type="application/json")
 
 @app.get("/health")
 def health():